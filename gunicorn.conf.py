@@ -0,0 +1,9 @@
+import multiprocessing
+
+# I/O-bound handlers (most time is spent waiting on the Dune API), so
+# scale with processes x threads rather than one worker per request.
+workers = multiprocessing.cpu_count() * 2 + 1
+threads = 4
+worker_class = "gthread"
+# Dune fetches can legitimately take up to 60s; leave headroom.
+timeout = 120